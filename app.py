@@ -2,100 +2,243 @@
 import streamlit as st
 import sqlite3
 import pandas as pd
+import numpy as np
 import datetime as dt
 from io import BytesIO
 from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
 import hashlib
+import hmac
 import os
+import tempfile
+import threading
+from contextlib import contextmanager
 
 DB_FILE = "rent_collection.db"
 
 # ------------- DB Helpers -------------
-def conn():
-    return sqlite3.connect(DB_FILE, check_same_thread=False)
+@st.cache_resource
+def get_conn():
+    # One long-lived connection per process; Streamlit reruns reuse it instead of reconnecting.
+    c = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
+    c.execute("PRAGMA journal_mode=WAL")
+    c.execute("PRAGMA synchronous=NORMAL")
+    c.execute("PRAGMA temp_store=MEMORY")
+    c.execute("PRAGMA cache_size=-20000")
+    return c
+
+@st.cache_resource
+def get_write_lock():
+    # One writer at a time on the shared connection, across every session's thread.
+    # Cached rather than a module global because Streamlit re-executes this script
+    # on each rerun; reentrant so write helpers can also be called inside write_tx().
+    return threading.RLock()
+
+@contextmanager
+def write_tx():
+    """Run a multi-statement change as one BEGIN IMMEDIATE ... COMMIT (rolled back on error)."""
+    c = get_conn()
+    with get_write_lock():
+        c.execute("BEGIN IMMEDIATE")
+        with c:
+            yield c
 
 def hash_pw(pw: str) -> str:
     return hashlib.sha256(pw.encode("utf-8")).hexdigest()
 
 def init_db():
-    c = conn()
+    c = get_conn()
     cur = c.cursor()
 
-    # users
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS users(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT UNIQUE NOT NULL,
-        password_hash TEXT NOT NULL,
-        role TEXT NOT NULL CHECK(role IN ('admin','employee'))
-    )
-    """)
+    # DDL and seeding run on every rerun; keep them clear of other sessions' writes
+    with get_write_lock():
+        # users
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS users(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            role TEXT NOT NULL CHECK(role IN ('admin','employee'))
+        )
+        """)
 
-    # tenants
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS tenants(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT NOT NULL,
-        rent REAL NOT NULL,
-        rental_address TEXT,
-        original_address TEXT,
-        joining_date DATE NOT NULL,
-        opening_balance REAL DEFAULT 0
-    )
-    """)
+        # tenants
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS tenants(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            rent REAL NOT NULL,
+            rental_address TEXT,
+            original_address TEXT,
+            joining_date DATE NOT NULL,
+            opening_balance REAL DEFAULT 0
+        )
+        """)
 
-    # payments (money received)
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS payments(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        tenant_id INTEGER NOT NULL,
-        payment_date DATE NOT NULL,
-        amount REAL NOT NULL,
-        mode TEXT,
-        employee TEXT,
-        remarks TEXT,
-        FOREIGN KEY (tenant_id) REFERENCES tenants(id)
-    )
-    """)
+        # payments (money received)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS payments(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tenant_id INTEGER NOT NULL,
+            payment_date DATE NOT NULL,
+            amount REAL NOT NULL,
+            mode TEXT,
+            employee TEXT,
+            remarks TEXT,
+            FOREIGN KEY (tenant_id) REFERENCES tenants(id)
+        )
+        """)
 
-    # charges (rent/fees added each month)
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS charges(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        tenant_id INTEGER NOT NULL,
-        charge_date DATE NOT NULL,
-        amount REAL NOT NULL,
-        note TEXT,
-        FOREIGN KEY (tenant_id) REFERENCES tenants(id)
-    )
-    """)
+        # charges (rent/fees added each month)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS charges(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tenant_id INTEGER NOT NULL,
+            charge_date DATE NOT NULL,
+            amount REAL NOT NULL,
+            note TEXT,
+            FOREIGN KEY (tenant_id) REFERENCES tenants(id)
+        )
+        """)
+
+        # meta (small key/value facts about the database, e.g. last backfilled month)
+        cur.execute("CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value TEXT)")
+
+        # indexes for the per-tenant sums and per-month (substr(date,1,7) = 'YYYY-MM') lookups
+        cur.execute("CREATE INDEX IF NOT EXISTS ix_charges_tid_date ON charges(tenant_id, charge_date)")
+        cur.execute("CREATE INDEX IF NOT EXISTS ix_payments_tid_date ON payments(tenant_id, payment_date)")
+        cur.execute("CREATE INDEX IF NOT EXISTS ix_charges_tid_ym ON charges(tenant_id, substr(charge_date,1,7))")
+        cur.execute("CREATE INDEX IF NOT EXISTS ix_payments_tid_ym ON payments(tenant_id, substr(payment_date,1,7))")
 
-    # default users if none exist
-    cur.execute("SELECT COUNT(*) FROM users")
-    if (cur.fetchone() or [0])[0] == 0:
-        cur.execute("INSERT INTO users (username,password_hash,role) VALUES (?,?,?)",
-                    ("admin", hash_pw("admin123"), "admin"))
-        cur.execute("INSERT INTO users (username,password_hash,role) VALUES (?,?,?)",
-                    ("employee", hash_pw("emp123"), "employee"))
-    c.commit(); c.close()
+        # default users if none exist (hashed only when actually seeding)
+        cur.execute("SELECT COUNT(*) FROM users")
+        if (cur.fetchone() or [0])[0] == 0:
+            cur.executemany("INSERT INTO users (username,password_hash,role) VALUES (?,?,?)", [
+                ("admin", hash_pw("admin123"), "admin"),
+                ("employee", hash_pw("emp123"), "employee"),
+            ])
 
 def auth_user(username, password):
-    c = conn(); cur = c.cursor()
+    c = get_conn(); cur = c.cursor()
     cur.execute("SELECT id, username, password_hash, role FROM users WHERE username=?", (username,))
     row = cur.fetchone()
-    c.close()
-    if row and row[2] == hash_pw(password):
+    if row and hmac.compare_digest(row[2], hash_pw(password)):
         return {"id": row[0], "username": row[1], "role": row[3]}
     return None
 
+# ------------- Cached reads -------------
+# Read queries are memoized with st.cache_data and keyed on a "db_ver" counter.
+# The counter is process-wide like the cache itself (not per session), so a write
+# in any session makes every session re-read on its next rerun.
+@st.cache_resource
+def _db_ver_state():
+    return {"v": 0, "lock": threading.Lock()}
+
+def db_ver() -> int:
+    return _db_ver_state()["v"]
+
+def bump_db_ver():
+    state = _db_ver_state()
+    with state["lock"]:
+        state["v"] += 1
+
+@st.cache_data(show_spinner=False)
+def load_tenants(v: int):
+    return pd.read_sql_query("SELECT * FROM tenants ORDER BY name", get_conn())
+
+# Unified ledger (opening + charges + payments) with the running net computed by a
+# window function, so the page only has to display the rows.
+LEDGER_SQL = """
+    SELECT date, type, description, debit, credit,
+           SUM(credit - debit) OVER (ORDER BY date, type_ord, id ROWS UNBOUNDED PRECEDING) AS "Running Net"
+    FROM (
+        SELECT :joining_date AS date, 'Opening' AS type, 'Opening Balance' AS description,
+               :opening_balance AS debit, 0.0 AS credit, 0 AS type_ord, 0 AS id
+        UNION ALL
+        SELECT charge_date, 'Charge', COALESCE(NULLIF(note, ''), 'Monthly Rent'),
+               COALESCE(amount, 0), 0.0, 1, id
+        FROM charges WHERE tenant_id = :tid
+        UNION ALL
+        SELECT payment_date, 'Payment',
+               COALESCE(NULLIF(TRIM(
+                   TRIM(COALESCE(mode, ''))
+                   || CASE WHEN COALESCE(employee, '') <> '' THEN ' by ' || employee ELSE '' END
+                   || CASE WHEN COALESCE(remarks, '') <> '' THEN ' — ' || remarks ELSE '' END
+               ), ''), 'Payment'),
+               0.0, COALESCE(amount, 0), 2, id
+        FROM payments WHERE tenant_id = :tid
+    )
+    ORDER BY date, type_ord, id
+"""
+
+@st.cache_data(show_spinner=False)
+def load_ledger(tid: int, joining_date: str, opening_balance: float, v: int):
+    return pd.read_sql_query(LEDGER_SQL, get_conn(), params={
+        "tid": tid, "joining_date": joining_date, "opening_balance": opening_balance,
+    })
+
+@st.cache_data(show_spinner=False)
+def render_ledger_html(tid: int, joining_date: str, opening_balance: float, v: int) -> str:
+    """Ledger as styled HTML (red for negative running net); cached so reruns skip the Styler."""
+    df = load_ledger(tid, joining_date, opening_balance, v).rename(columns={
+        "date": "Date", "type": "Type", "description": "Description",
+        "debit": "Debit (₹)", "credit": "Credit (₹)"
+    })
+    html = (
+        df.style
+        .map(lambda x: "background-color: red; color: white;" if x < 0 else "", subset=["Running Net"])
+        # escape every cell: descriptions carry user-typed remarks/notes and the HTML
+        # goes to st.markdown(unsafe_allow_html=True)
+        .format(precision=2, escape="html")
+        .hide(axis="index")
+        .to_html()
+    )
+    return f'<div style="max-height: 480px; overflow: auto;">{html}</div>'
+
+@st.cache_data(show_spinner=False)
+def load_collections(v: int):
+    return pd.read_sql_query("""
+        SELECT p.id, t.name as tenant, p.payment_date, p.amount, p.mode, p.employee, p.remarks
+        FROM payments p JOIN tenants t ON t.id=p.tenant_id
+        ORDER BY p.payment_date DESC, p.id DESC
+    """, get_conn())
+
+@st.cache_data(show_spinner=False)
+def load_all_balances(year_month: str, v: int):
+    """Net balance and current-month delay flag per tenant id (two GROUP BY reads, no per-tenant queries)."""
+    c = get_conn()
+    tenants = pd.read_sql_query("SELECT id, COALESCE(opening_balance,0) AS opening_balance FROM tenants", c)
+    ch = pd.read_sql_query("""
+        SELECT tenant_id AS id, COALESCE(SUM(amount),0) AS charge_sum,
+               SUM(CASE WHEN substr(charge_date,1,7)=? THEN amount ELSE 0 END) AS cm_c
+        FROM charges GROUP BY tenant_id
+    """, c, params=(year_month,))
+    pay = pd.read_sql_query("""
+        SELECT tenant_id AS id, COALESCE(SUM(amount),0) AS pay_sum,
+               SUM(CASE WHEN substr(payment_date,1,7)=? THEN amount ELSE 0 END) AS cm_p
+        FROM payments GROUP BY tenant_id
+    """, c, params=(year_month,))
+    df = tenants.merge(ch, on="id", how="left").merge(pay, on="id", how="left").fillna(0)
+    df["Net Balance"] = df["pay_sum"] - (df["opening_balance"] + df["charge_sum"])
+    df["This Month Delayed?"] = df["cm_p"] < df["cm_c"]
+    return df[["id", "Net Balance", "This Month Delayed?"]]
+
+@st.cache_data(show_spinner=False)
+def load_report(year_month: str, v: int):
+    """Report frame: tenants + balances, with a Status marker instead of cell styling."""
+    df = load_tenants(v).merge(load_all_balances(year_month, v), on="id", how="left")
+    df["Status"] = np.select(
+        [df["Net Balance"] < 0, df["This Month Delayed?"].astype(bool)], ["🔴", "🟡"], default=""
+    )
+    return df
+
 # ------------- Ledger math -------------
 # We define NET BALANCE from the user's requirement (red for negative):
 # net = payments_total - (opening_balance + charges_total)
 #   < 0  => owes (arrears)  -> 🔴 red
 #   >=0  => on time/advance
 def tenant_net_balance(tenant_id: int):
-    c = conn(); cur = c.cursor()
+    c = get_conn(); cur = c.cursor()
     cur.execute("SELECT opening_balance FROM tenants WHERE id=?", (tenant_id,))
     ob = (cur.fetchone() or [0])[0] or 0
 
@@ -104,107 +247,109 @@ def tenant_net_balance(tenant_id: int):
 
     cur.execute("SELECT COALESCE(SUM(amount),0) FROM payments WHERE tenant_id=?", (tenant_id,))
     payments = (cur.fetchone() or [0])[0] or 0
-    c.close()
     return payments - (ob + charges)
 
 def month_has_delay(tenant_id: int, year_month: str):
     """Yellow highlight if current-month paid < current-month charges."""
-    c = conn(); cur = c.cursor()
-    cur.execute("""
-        SELECT COALESCE(SUM(amount),0) FROM charges
-        WHERE tenant_id=? AND strftime('%Y-%m', charge_date)=?
-    """, (tenant_id, year_month))
-    cm_charges = (cur.fetchone() or [0])[0] or 0
-
+    c = get_conn(); cur = c.cursor()
+    # both monthly sums in one statement; substr(...) matches the (tenant_id, month) expression indexes
     cur.execute("""
-        SELECT COALESCE(SUM(amount),0) FROM payments
-        WHERE tenant_id=? AND strftime('%Y-%m', payment_date)=?
-    """, (tenant_id, year_month))
-    cm_pay = (cur.fetchone() or [0])[0] or 0
-    c.close()
+        SELECT (SELECT COALESCE(SUM(amount),0) FROM charges
+                WHERE tenant_id=? AND substr(charge_date,1,7)=?),
+               (SELECT COALESCE(SUM(amount),0) FROM payments
+                WHERE tenant_id=? AND substr(payment_date,1,7)=?)
+    """, (tenant_id, year_month, tenant_id, year_month))
+    cm_charges, cm_pay = cur.fetchone()
     return cm_pay < cm_charges
 
-def ensure_backfilled_charges_for_tenant(tenant_id: int):
+# One set-oriented INSERT generates every month from joining_date to the current
+# month (recursive CTE) and inserts the ones not yet charged. :tid = NULL covers all tenants.
+BACKFILL_SQL = """
+    INSERT INTO charges (tenant_id, charge_date, amount, note)
+    WITH RECURSIVE months(tenant_id, rent, d) AS (
+        SELECT id, rent, date(joining_date, 'start of month') FROM tenants
+        WHERE :tid IS NULL OR id = :tid
+        UNION ALL
+        SELECT tenant_id, rent, date(d, '+1 month') FROM months
+        WHERE d < :this_month
+    )
+    SELECT m.tenant_id, m.d, m.rent, 'Monthly Rent' FROM months m
+    WHERE m.d <= :this_month AND NOT EXISTS (
+        SELECT 1 FROM charges ch
+        WHERE ch.tenant_id = m.tenant_id
+          AND substr(ch.charge_date,1,7) = substr(m.d,1,7)
+    )
+"""
+
+def _backfill_charges(tenant_id=None) -> int:
+    """Insert the missing monthly charges and return how many were added.
+
+    Callers run this inside write_tx() and bump_db_ver() only after it commits, so no
+    session caches uncommitted rows under the new version.
+    """
+    this_month = dt.date.today().replace(day=1).isoformat()
+    with get_write_lock():
+        cur = get_conn().execute(BACKFILL_SQL, {"tid": tenant_id, "this_month": this_month})
+    return cur.rowcount
+
+def ensure_backfilled_charges_for_tenant(tenant_id: int) -> int:
     """
     Ensure monthly rent charges exist from joining_date through current month.
     If rent changes later, future months will use the updated rent automatically.
+    Returns the number of charges added.
     """
-    today = dt.date.today()
-    first_this_month = today.replace(day=1)
-    y_m_now = first_this_month.strftime("%Y-%m")
-
-    c = conn(); cur = c.cursor()
-    cur.execute("SELECT joining_date, rent FROM tenants WHERE id=?", (tenant_id,))
-    row = cur.fetchone()
-    if not row:
-        c.close(); return
-    join_date = dt.date.fromisoformat(row[0])
-    rent_now = row[1]
-
-    # find last month charged
-    cur.execute("""
-        SELECT MAX(strftime('%Y-%m', charge_date))
-        FROM charges WHERE tenant_id=?
-    """, (tenant_id,))
-    last_ym = (cur.fetchone() or [None])[0]
-
-    # start month is max(join_month, last_ym+1)
-    start_date = join_date.replace(day=1)
-    if last_ym:
-        y, m = map(int, last_ym.split("-"))
-        last_first = dt.date(y, m, 1)
-        # next month
-        nm_y = last_first.year + (1 if last_first.month == 12 else 0)
-        nm_m = 1 if last_first.month == 12 else last_first.month + 1
-        next_first = dt.date(nm_y, nm_m, 1)
-        if next_first > start_date:
-            start_date = next_first
-
-    # loop months to current inclusive
-    cur2 = c.cursor()
-    cursor_date = start_date
-    while cursor_date <= first_this_month:
-        ym = cursor_date.strftime("%Y-%m")
-        # fetch rent in that month (rent may have changed; we’ll fetch current rent each insert time.
-        cur2.execute("SELECT rent FROM tenants WHERE id=?", (tenant_id,))
-        rent_for_month = (cur2.fetchone() or [rent_now])[0] or rent_now
-        cur.execute("""
-            INSERT INTO charges (tenant_id, charge_date, amount, note)
-            VALUES (?, ?, ?, ?)
-        """, (tenant_id, cursor_date.isoformat(), float(rent_for_month), "Monthly Rent"))
-        # advance one month
-        ny = cursor_date.year + (1 if cursor_date.month == 12 else 0)
-        nm = 1 if cursor_date.month == 12 else cursor_date.month + 1
-        cursor_date = dt.date(ny, nm, 1)
-
-    c.commit(); c.close()
+    # fast path: already charged for the current month (MAX is a seek on ix_charges_tid_date)
+    last_ym = get_conn().execute(
+        "SELECT substr(MAX(charge_date),1,7) FROM charges WHERE tenant_id=?", (tenant_id,)
+    ).fetchone()[0]
+    if last_ym == dt.date.today().strftime("%Y-%m"):
+        return 0
+    return _backfill_charges(tenant_id)
 
 def ensure_backfilled_charges_for_all():
-    c = conn(); df = pd.read_sql_query("SELECT id FROM tenants", c); c.close()
-    for tid in df["id"].tolist():
-        ensure_backfilled_charges_for_tenant(tid)
+    """Backfill every tenant at most once per calendar month (session flag, then the persisted meta row)."""
+    ym = dt.date.today().strftime("%Y-%m")
+    if st.session_state.get("bf_ym") == ym:
+        return
+    row = get_conn().execute("SELECT value FROM meta WHERE key='backfilled_ym'").fetchone()
+    if not row or row[0] != ym:
+        with write_tx() as c:
+            added = _backfill_charges()
+            c.execute("INSERT OR REPLACE INTO meta(key, value) VALUES ('backfilled_ym', ?)", (ym,))
+        if added > 0:
+            bump_db_ver()
+    st.session_state["bf_ym"] = ym
 
 # ------------- PDF Receipt -------------
-def build_receipt_pdf(tenant_name, flat_addr, payment_date, amount, mode, remarks, new_net_balance):
-    bio = BytesIO()
-    pdf = canvas.Canvas(bio, pagesize=A4)
+def build_receipt_pdf(tenant_name, flat_addr, payment_date, amount, mode, remarks, new_net_balance, out=None):
+    """
+    Write a receipt into `out` (any binary file object; a new BytesIO by default) and return it rewound.
+    Bulk exports can pass e.g. tempfile.SpooledTemporaryFile(max_size=256*1024) to bound memory.
+    """
+    bio = out if out is not None else BytesIO()
+    # deflate the page stream so it is compressed before it lands in the buffer
+    pdf = canvas.Canvas(bio, pagesize=A4, pageCompression=1)
     pdf.setTitle("Rent Receipt")
 
-    x, y = 50, 800
-    pdf.setFont("Helvetica-Bold", 16); pdf.drawString(x, y, "RENT RECEIPT")
-    pdf.setFont("Helvetica", 11)
-    y -= 30; pdf.drawString(x, y, f"Tenant: {tenant_name}")
-    y -= 20; pdf.drawString(x, y, f"Rental Address: {flat_addr or '-'}")
-    y -= 20; pdf.drawString(x, y, f"Date: {payment_date}")
-    y -= 20; pdf.drawString(x, y, f"Payment Mode: {mode or '-'}")
-    y -= 20; pdf.drawString(x, y, f"Remarks: {remarks or '-'}")
-    y -= 30; pdf.setFont("Helvetica-Bold", 12)
-    pdf.drawString(x, y, f"Amount Received: ₹{amount:,.2f}")
-    y -= 20
+    # all receipt text in a single text object (one BT/ET)
+    t = pdf.beginText(50, 800)
+    t.setFont("Helvetica-Bold", 16); t.textLine("RENT RECEIPT")
+    t.setTextOrigin(50, 770)
+    t.setFont("Helvetica", 11, leading=20)
+    t.textLines([
+        f"Tenant: {tenant_name}",
+        f"Rental Address: {flat_addr or '-'}",
+        f"Date: {payment_date}",
+        f"Payment Mode: {mode or '-'}",
+        f"Remarks: {remarks or '-'}",
+    ])
+    t.setFont("Helvetica-Bold", 12)
+    t.setTextOrigin(50, 660); t.textLine(f"Amount Received: ₹{amount:,.2f}")
     bal_label = "Net Balance (payments - (opening + charges))"
-    pdf.setFont("Helvetica", 10); pdf.drawString(x, y, bal_label)
-    y -= 18; pdf.setFont("Helvetica-Bold", 12)
-    pdf.drawString(x, y, f"After This Payment: ₹{new_net_balance:,.2f}")
+    t.setFont("Helvetica", 10); t.setTextOrigin(50, 640); t.textLine(bal_label)
+    t.setFont("Helvetica-Bold", 12)
+    t.setTextOrigin(50, 622); t.textLine(f"After This Payment: ₹{new_net_balance:,.2f}")
+    pdf.drawText(t)
     # footer
     pdf.showPage(); pdf.save()
     bio.seek(0)
@@ -243,22 +388,21 @@ def page_tenants():
             if not name or rent is None:
                 st.error("Please fill Name and Monthly Rent")
             else:
-                c = conn(); cur = c.cursor()
-                cur.execute("""
-                    INSERT INTO tenants(name, rent, rental_address, original_address, joining_date, opening_balance)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                """, (name, rent, rental_addr, original_addr, joining_date.isoformat(), opening_balance))
-                t_id = cur.lastrowid
-                c.commit(); c.close()
-
-                # Backfill charges starting from joining date up to current month
-                ensure_backfilled_charges_for_tenant(t_id)
+                with write_tx() as c:
+                    cur = c.cursor()
+                    cur.execute("""
+                        INSERT INTO tenants(name, rent, rental_address, original_address, joining_date, opening_balance)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                    """, (name, rent, rental_addr, original_addr, joining_date.isoformat(), opening_balance))
+                    t_id = cur.lastrowid
+
+                    # Backfill charges starting from joining date up to current month
+                    ensure_backfilled_charges_for_tenant(t_id)
+                bump_db_ver()
                 st.success("Tenant added and charges backfilled ✔")
 
     # List / Edit / Delete / Export
-    c = conn()
-    df = pd.read_sql_query("SELECT * FROM tenants", c)
-    c.close()
+    df = load_tenants(db_ver())
     st.subheader("Tenant List")
     st.dataframe(df, use_container_width=True)
 
@@ -266,7 +410,8 @@ def page_tenants():
         if df.empty:
             st.info("No tenants yet.")
         else:
-            tid = st.selectbox("Select Tenant", df["id"], format_func=lambda x: df.loc[df["id"]==x,"name"].iloc[0])
+            id2name = dict(zip(df["id"].tolist(), df["name"].tolist()))
+            tid = st.selectbox("Select Tenant", df["id"].tolist(), format_func=id2name.get)
             row = df[df["id"]==tid].iloc[0]
             e1, e2 = st.columns(2)
             with e1:
@@ -281,22 +426,27 @@ def page_tenants():
             ucol1, ucol2, ucol3 = st.columns([1,1,2])
             with ucol1:
                 if st.button("Update"):
-                    c = conn(); cur = c.cursor()
-                    cur.execute("""
-                        UPDATE tenants SET name=?, rent=?, rental_address=?, original_address=?,
-                        joining_date=?, opening_balance=? WHERE id=?
-                    """, (new_name, new_rent, new_rental, new_orig, new_join.isoformat(), new_ob, int(tid)))
-                    c.commit(); c.close()
+                    with write_tx() as c:
+                        cur = c.cursor()
+                        cur.execute("""
+                            UPDATE tenants SET name=?, rent=?, rental_address=?, original_address=?,
+                            joining_date=?, opening_balance=? WHERE id=?
+                        """, (new_name, new_rent, new_rental, new_orig, new_join.isoformat(), new_ob, int(tid)))
+                        # an earlier joining date needs its months charged now, not next month
+                        # (full check: the current month is usually charged already)
+                        _backfill_charges(int(tid))
+                    bump_db_ver()
                     st.success("Tenant updated.")
                     st.rerun()
             with ucol2:
                 if st.button("Delete", type="primary"):
-                    c = conn(); cur = c.cursor()
-                    # delete child rows first
-                    cur.execute("DELETE FROM payments WHERE tenant_id=?", (int(tid),))
-                    cur.execute("DELETE FROM charges  WHERE tenant_id=?", (int(tid),))
-                    cur.execute("DELETE FROM tenants WHERE id=?", (int(tid),))
-                    c.commit(); c.close()
+                    with write_tx() as c:
+                        cur = c.cursor()
+                        # delete child rows first
+                        cur.execute("DELETE FROM payments WHERE tenant_id=?", (int(tid),))
+                        cur.execute("DELETE FROM charges  WHERE tenant_id=?", (int(tid),))
+                        cur.execute("DELETE FROM tenants WHERE id=?", (int(tid),))
+                    bump_db_ver()
                     st.success("Tenant and related records deleted.")
                     st.rerun()
 
@@ -310,16 +460,15 @@ def page_collect_rent():
     # ensure monthly charges are backfilled before collection
     ensure_backfilled_charges_for_all()
 
-    c = conn()
-    tenants = pd.read_sql_query("SELECT id, name, rental_address FROM tenants ORDER BY name", c)
-    c.close()
-    if tenants.empty:
+    # small lookup: plain tuples + dict, no DataFrame
+    rows = get_conn().execute("SELECT id, name, rental_address FROM tenants ORDER BY name").fetchall()
+    if not rows:
         st.warning("No tenants available. Ask admin to add tenants.")
         return
 
-    tname = st.selectbox("Tenant", tenants["name"])
-    trow = tenants[tenants["name"]==tname].iloc[0]
-    tid = int(trow["id"])
+    by_name = {r[1]: r for r in rows}
+    tname = st.selectbox("Tenant", list(by_name))
+    tid, _, flat = by_name[tname]
 
     # Show current month status & net balance
     today = dt.date.today()
@@ -339,20 +488,20 @@ def page_collect_rent():
     pdate = st.date_input("Payment Date", value=today)
 
     if st.button("Save Payment"):
-        c = conn(); cur = c.cursor()
         employee_name = st.session_state.get("user", {}).get("username", "")
-        cur.execute("""
-            INSERT INTO payments(tenant_id, payment_date, amount, mode, employee, remarks)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (tid, pdate.isoformat(), float(amt), mode, employee_name, remarks))
-        c.commit(); c.close()
+        with write_tx() as c:
+            c.execute("""
+                INSERT INTO payments(tenant_id, payment_date, amount, mode, employee, remarks)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (tid, pdate.isoformat(), float(amt), mode, employee_name, remarks))
+        bump_db_ver()
         st.success("Payment saved ✔")
 
         # new net balance and receipt
         net_after = tenant_net_balance(tid)
         pdf = build_receipt_pdf(
             tenant_name=tname,
-            flat_addr=trow["rental_address"],
+            flat_addr=flat,
             payment_date=pdate.isoformat(),
             amount=float(amt),
             mode=mode,
@@ -368,40 +517,25 @@ def page_reports():
     # Always backfill before reporting to keep things consistent
     ensure_backfilled_charges_for_all()
 
-    c = conn()
-    tenants = pd.read_sql_query("""
-        SELECT id, name, rent, rental_address, original_address, joining_date, opening_balance
-        FROM tenants ORDER BY name
-    """, c)
-    c.close()
+    # net balance and current-month delay per tenant
+    ym = dt.date.today().strftime("%Y-%m")
+    tenants = load_report(ym, db_ver())
     if tenants.empty:
         st.info("No tenants yet.")
         return
 
-    # compute net balance per tenant
-    nets = []
-    cm_delay = []
-    ym = dt.date.today().strftime("%Y-%m")
-    for _, r in tenants.iterrows():
-        nb = tenant_net_balance(int(r["id"]))
-        nets.append(nb)
-        cm_delay.append(month_has_delay(int(r["id"]), ym))
-    tenants["Net Balance"] = nets
-    tenants["This Month Delayed?"] = cm_delay
-
-    # style: red for negative net, yellow if delayed this month
-    def row_style(row):
-        styles = []
-        for col in tenants.columns:
-            style = ""
-            if col == "Net Balance" and row["Net Balance"] < 0:
-                style = "background-color: red; color: white;"
-            elif col == "This Month Delayed?" and row["This Month Delayed?"]:
-                style = "background-color: yellow; color: black;"
-            styles.append(style)
-        return styles
-
-    st.dataframe(tenants.style.apply(row_style, axis=1), use_container_width=True)
+    # 🔴 negative net, 🟡 delayed this month (Status column) — plain frame, no Styler
+    m1, m2 = st.columns(2)
+    m1.metric("🔴 Tenants in arrears", int(tenants["Net Balance"].lt(0).sum()))
+    m2.metric("🟡 Delayed this month", int(tenants["This Month Delayed?"].sum()))
+    st.dataframe(
+        tenants, use_container_width=True,
+        column_config={
+            "rent": st.column_config.NumberColumn(format="₹%.2f"),
+            "opening_balance": st.column_config.NumberColumn(format="₹%.2f"),
+            "Net Balance": st.column_config.NumberColumn(format="₹%.2f"),
+        }
+    )
 
     # quick filters / export
     st.subheader("Export")
@@ -410,32 +544,56 @@ def page_reports():
 
     # collections view
     st.subheader("All Collections")
-    c = conn()
-    coll = pd.read_sql_query("""
-        SELECT p.id, t.name as tenant, p.payment_date, p.amount, p.mode, p.employee, p.remarks
-        FROM payments p JOIN tenants t ON t.id=p.tenant_id
-        ORDER BY p.payment_date DESC, p.id DESC
-    """, c)
-    c.close()
+    coll = load_collections(db_ver())
     st.dataframe(coll, use_container_width=True)
 
 def page_backup_restore():
     st.title("🗄️ Backup & Restore (Admin)")
 
-    # Download db
-    if os.path.exists(DB_FILE):
-        with open(DB_FILE, "rb") as f:
+    # Download db: a consistent snapshot through SQLite's online backup API (includes
+    # the WAL, no checkpoint needed), taken under the write lock so no other session's
+    # transaction is open on the shared connection meanwhile. Only on request.
+    if st.button("Prepare Backup"):
+        with tempfile.NamedTemporaryFile(suffix=".db", delete=False) as tmp:
+            snapshot = tmp.name
+        dst = sqlite3.connect(snapshot)
+        with get_write_lock():
+            get_conn().backup(dst)
+        dst.close()
+        with open(snapshot, "rb") as f:
             st.download_button("⬇️ Download SQLite DB", f, file_name="rent_backup.db", mime="application/octet-stream")
-    else:
-        st.warning("No database file found.")
+        os.remove(snapshot)
 
-    # Upload db
-    up = st.file_uploader("Upload a SQLite backup (.db)", type=["db"])
+    if st.session_state.pop("restored", False):
+        st.success("Database restored ✔")
+
+    # Upload db: copied into the live connection with the backup API, so every session
+    # keeps its (still open) connection and sees the restored data. The uploader is keyed
+    # per restore so the same file is not restored again on the next rerun.
+    n = st.session_state.get("restore_n", 0)
+    up = st.file_uploader("Upload a SQLite backup (.db)", type=["db"], key=f"restore_upload_{n}")
     if up is not None:
-        with open(DB_FILE, "wb") as f:
-            f.write(up.getbuffer())
-        st.success("Database restored. Please reload the app.")
+        with tempfile.NamedTemporaryFile(suffix=".db", delete=False) as tmp:
+            tmp.write(up.getbuffer())
+        src = sqlite3.connect(tmp.name)
+        try:
+            with get_write_lock():
+                src.backup(get_conn())
+        except sqlite3.DatabaseError as e:
+            st.error(f"Not a valid SQLite backup: {e}")
+            return
+        finally:
+            src.close()
+            os.remove(tmp.name)
+        st.cache_data.clear()
+        bump_db_ver()
+        # the restored file may predate this month's charges
+        st.session_state.pop("bf_ym", None)
+        ensure_backfilled_charges_for_all()
+        st.session_state["restore_n"] = n + 1
+        st.session_state["restored"] = True
         st.rerun()
+
 def page_ledger():
     import itertools
     st.title("📒 Tenant Ledger (Employee/Admin)")
@@ -444,93 +602,21 @@ def page_ledger():
     ensure_backfilled_charges_for_all()
 
     # ---- Pick Tenant ----
-    c = conn()
-    tenants = pd.read_sql_query(
-        "SELECT id, name, rental_address, joining_date, opening_balance FROM tenants ORDER BY name", c
-    )
-    c.close()
-    if tenants.empty:
+    rows = get_conn().execute(
+        "SELECT id, name, joining_date, opening_balance FROM tenants ORDER BY name"
+    ).fetchall()
+    if not rows:
         st.info("No tenants yet.")
         return
 
-    tname = st.selectbox("Tenant", tenants["name"])
-    trow = tenants[tenants["name"] == tname].iloc[0]
-    tid = int(trow["id"])
-    joining_date = dt.date.fromisoformat(trow["joining_date"])
-    opening_balance = float(trow["opening_balance"] or 0)
-
-    # ---- Pull charges & payments ----
-    c = conn()
-    charges = pd.read_sql_query(
-        """
-        SELECT id, charge_date AS date, amount, COALESCE(note,'') AS note
-        FROM charges WHERE tenant_id=? ORDER BY date, id
-        """,
-        c, params=(tid,)
-    )
-    pays = pd.read_sql_query(
-        """
-        SELECT id, payment_date AS date, amount, COALESCE(mode,'') AS mode,
-               COALESCE(employee,'') AS employee, COALESCE(remarks,'') AS remarks
-        FROM payments WHERE tenant_id=? ORDER BY date, id
-        """,
-        c, params=(tid,)
-    )
-    c.close()
-
-    # ---- Build unified ledger events ----
-    events = []
-
-    # Opening balance as the very first event (acts like a charge)
-    events.append({
-        "date": joining_date.isoformat(),
-        "type": "Opening",
-        "description": "Opening Balance",
-        "debit": opening_balance,   # money owed
-        "credit": 0.0
-    })
+    by_name = {r[1]: r for r in rows}
+    tname = st.selectbox("Tenant", list(by_name))
+    tid, _, joining, ob = by_name[tname]
+    joining_date = dt.date.fromisoformat(joining)
+    opening_balance = float(ob or 0)
 
-    # Charges -> Debit
-    for _, r in charges.iterrows():
-        events.append({
-            "date": r["date"],
-            "type": "Charge",
-            "description": r["note"] or "Monthly Rent",
-            "debit": float(r["amount"] or 0),
-            "credit": 0.0
-        })
-
-    # Payments -> Credit
-    for _, r in pays.iterrows():
-        desc = f"{r['mode']}".strip()
-        if r["employee"]:
-            desc += f" by {r['employee']}"
-        if r["remarks"]:
-            desc += f" — {r['remarks']}"
-        events.append({
-            "date": r["date"],
-            "type": "Payment",
-            "description": desc.strip() or "Payment",
-            "debit": 0.0,
-            "credit": float(r["amount"] or 0)
-        })
-
-    # Sort by date, then by type priority (Opening -> Charge -> Payment) to keep stable ordering on same date
-    type_order = {"Opening": 0, "Charge": 1, "Payment": 2}
-    events.sort(key=lambda e: (e["date"], type_order.get(e["type"], 9)))
-
-    # ---- Compute running net (payments - (opening + charges)) ----
-    running = []
-    net = 0.0
-    for e in events:
-        if e["type"] in ("Opening", "Charge"):
-            net -= e["debit"]
-        elif e["type"] == "Payment":
-            net += e["credit"]
-        running.append(net)
-
-    ledger_df = pd.DataFrame(events)
-    ledger_df["Running Net"] = running
+    # ---- Ledger events + running net (payments - (opening + charges)) ----
+    ledger_df = load_ledger(tid, joining_date.isoformat(), opening_balance, db_ver())
 
     # ---- Current month status ----
     ym = dt.date.today().strftime("%Y-%m")
@@ -542,24 +628,10 @@ def page_ledger():
         f"{'— 🟡 Current month not fully paid' if delayed else ''}"
     )
 
-    # ---- Style: red for negative running balance ----
-    def style_row(row):
-        styles = []
-        for col in ledger_df.columns:
-            if col == "Running Net" and row["Running Net"] < 0:
-                styles.append("background-color: red; color: white;")
-            else:
-                styles.append("")
-        return styles
-
-    st.dataframe(
-        ledger_df[["date", "type", "description", "debit", "credit", "Running Net"]]
-        .rename(columns={
-            "date": "Date", "type": "Type", "description": "Description",
-            "debit": "Debit (₹)", "credit": "Credit (₹)"
-        })
-        .style.apply(style_row, axis=1),
-        use_container_width=True
+    # ---- Styled table (red for negative running balance), rendered once per data version ----
+    st.markdown(
+        render_ledger_html(tid, joining_date.isoformat(), opening_balance, db_ver()),
+        unsafe_allow_html=True
     )
 
     # ---- Downloads ----
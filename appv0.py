@@ -1,115 +1,248 @@
 import streamlit as st
 import sqlite3
 import hashlib
-import pandas as pd
+import hmac
+import bcrypt
 import os
+import tempfile
+import threading
 import datetime
-from io import BytesIO
+from contextlib import contextmanager
+
+# pandas and the Excel engines are imported inside the functions that use them,
+# so the login page renders without paying their import cost.
 
 DB_FILE = "rent.db"
+# Tenants added before start_date existed have no start date; count their
+# months from this anchor, which reproduces the old formula
+# (year - 2020) * 12 + month exactly, so their balances do not shift.
+LEGACY_START_DATE = "2019-12-01"
+BCRYPT_ROUNDS = 11  # ~150 ms per hash on a typical host; keeps login well under 250 ms
+BCRYPT_MAX_BYTES = 72  # bcrypt's input limit; bcrypt 5+ raises ValueError beyond it
 
 # -----------------------------
 # Database Setup
 # -----------------------------
 def init_db():
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_connection()
     c = conn.cursor()
 
-    # Users table
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            role TEXT NOT NULL
-        )
-    """)
-
-    # Tenants table
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS tenants (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            monthly_rent REAL NOT NULL,
-            rental_address TEXT,
-            original_address TEXT
-        )
-    """)
-
-    # Transactions table
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS transactions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            tenant_id INTEGER NOT NULL,
-            date TEXT NOT NULL,
-            amount REAL NOT NULL,
-            FOREIGN KEY (tenant_id) REFERENCES tenants(id)
-        )
-    """)
-
-    # Create default admin if not exists
-    c.execute("SELECT * FROM users WHERE username=?", ("admin",))
-    if not c.fetchone():
-        admin_pass = hashlib.sha256("admin123".encode()).hexdigest()
-        c.execute("INSERT INTO users (username, password_hash, role) VALUES (?, ?, ?)",
-                  ("admin", admin_pass, "admin"))
-    conn.commit()
-    conn.close()
+    # All DDL and the admin seed in one transaction: a single sync on cold start.
+    with write_tx():
+        # Users table
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT UNIQUE NOT NULL,
+                password_hash TEXT NOT NULL,
+                role TEXT NOT NULL
+            )
+        """)
+
+        # Tenants table
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS tenants (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                monthly_rent REAL NOT NULL,
+                rental_address TEXT,
+                original_address TEXT,
+                start_date TEXT
+            )
+        """)
+        # Older databases predate start_date
+        if "start_date" not in [col[1] for col in c.execute("PRAGMA table_info(tenants)")]:
+            c.execute("ALTER TABLE tenants ADD COLUMN start_date TEXT")
+
+        # Transactions table
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS transactions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                tenant_id INTEGER NOT NULL,
+                date TEXT NOT NULL,
+                amount REAL NOT NULL,
+                FOREIGN KEY (tenant_id) REFERENCES tenants(id)
+            )
+        """)
+
+        # Per-tenant lookups (balance sums, ledger, month filters) use this index;
+        # users.username is already indexed by its UNIQUE constraint.
+        c.execute("CREATE INDEX IF NOT EXISTS idx_tx_tenant_date ON transactions(tenant_id, date)")
+
+        # Create default admin if not exists
+        c.execute("SELECT * FROM users WHERE username=?", ("admin",))
+        if not c.fetchone():
+            c.execute("INSERT INTO users (username, password_hash, role) VALUES (?, ?, ?)",
+                      ("admin", hash_password("admin123"), "admin"))
 
 # -----------------------------
 # Utility Functions
 # -----------------------------
+@st.cache_resource
 def get_connection():
-    return sqlite3.connect(DB_FILE)
+    # Single long-lived connection reused across reruns (keeps SQLite's page cache hot).
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-20000")
+    return conn
+
+@st.cache_resource
+def get_write_lock():
+    # Every session shares the one connection, so only one BEGIN ... COMMIT may be open
+    # on it at a time. Cached rather than a module global: Streamlit re-executes this
+    # script on each rerun, which would hand every rerun a fresh lock.
+    return threading.Lock()
+
+@contextmanager
+def write_tx():
+    """BEGIN ... COMMIT on the shared connection under the write lock (rolled back on error)."""
+    conn = get_connection()
+    with get_write_lock():
+        conn.execute("BEGIN")
+        with conn:
+            yield conn
 
 def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
+    pw = password.encode()
+    if len(pw) > BCRYPT_MAX_BYTES:
+        raise ValueError(f"password cannot be longer than {BCRYPT_MAX_BYTES} bytes")
+    return bcrypt.hashpw(pw, bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode()
+
+def verify_password(password, stored):
+    if stored.startswith("$2"):
+        pw = password.encode()
+        # no stored bcrypt hash can come from a longer password
+        if len(pw) > BCRYPT_MAX_BYTES:
+            return False
+        return bcrypt.checkpw(pw, stored.encode())
+    # legacy unsalted SHA-256 hash from before bcrypt
+    return hmac.compare_digest(stored, hashlib.sha256(password.encode()).hexdigest())
 
 def login_user(username, password):
     conn = get_connection()
     c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE username=? AND password_hash=?", 
-              (username, hash_password(password)))
+    c.execute("SELECT * FROM users WHERE username=?", (username,))
     user = c.fetchone()
-    conn.close()
+    try:
+        if not user or not verify_password(password, user[2]):
+            return None
+    except ValueError:  # malformed stored hash
+        return None
+    if not user[2].startswith("$2") and len(password.encode()) <= BCRYPT_MAX_BYTES:
+        # upgrade a legacy hash to bcrypt on successful login (a password too long
+        # for bcrypt keeps its legacy hash)
+        new_hash = hash_password(password)  # outside the write lock; bcrypt is slow
+        with write_tx() as conn:
+            conn.execute("UPDATE users SET password_hash=? WHERE id=?", (new_hash, user[0]))
     return user
 
+# Table reads are cached and keyed on a cheap (row count, max id) token, so an
+# unchanged table is served from memory; writers also clear the cache explicitly.
+def _table_version(table):
+    return get_connection().execute(f"SELECT COUNT(*), COALESCE(MAX(id), 0) FROM {table}").fetchone()
+
+@st.cache_data(show_spinner=False)
+def _get_tenants(version):
+    import pandas as pd
+    return pd.read_sql("SELECT * FROM tenants", get_connection())
+
+@st.cache_data(show_spinner=False)
+def _get_tenant_options(version):
+    import pandas as pd
+    return pd.read_sql("SELECT id, name FROM tenants", get_connection())
+
+def to_excel_bytes(df, sheet_name):
+    import pandas as pd
+    from io import BytesIO
+    # Optional: xlsxwriter is the faster writer; fall back to openpyxl when absent.
+    # (Not constant_memory mode: that drops cells written out of row order, and
+    # to_excel writes column by column.)
+    try:
+        import xlsxwriter  # noqa: F401
+        engine = "xlsxwriter"
+    except ImportError:
+        engine = "openpyxl"
+    output = BytesIO()
+    with pd.ExcelWriter(output, engine=engine) as writer:
+        df.to_excel(writer, index=False, sheet_name=sheet_name)
+    return output.getvalue()
+
 def get_tenants():
-    conn = get_connection()
-    df = pd.read_sql("SELECT * FROM tenants", conn)
-    conn.close()
-    return df
+    return _get_tenants(_table_version("tenants"))
 
-def get_transactions():
-    conn = get_connection()
-    df = pd.read_sql("SELECT * FROM transactions", conn)
-    conn.close()
-    return df
+def get_tenant_options():
+    """Just (id, name) for the tenant selectboxes; the wide read stays on the Tenant List tab."""
+    return _get_tenant_options(_table_version("tenants"))
+
+# Constant SQL text so sqlite3's per-connection statement cache reuses the prepared INSERT
+INSERT_TX_SQL = "INSERT INTO transactions (tenant_id, date, amount) VALUES (?, ?, ?)"
+
+def record_payments(rows):
+    """Insert (tenant_id, date, amount) rows with one executemany in one transaction."""
+    with write_tx() as conn:
+        conn.executemany(INSERT_TX_SQL, rows)
+    _load_report.clear()
 
 def calculate_balance(tenant_id):
     conn = get_connection()
     c = conn.cursor()
-    c.execute("SELECT monthly_rent FROM tenants WHERE id=?", (tenant_id,))
-    rent = c.fetchone()[0]
+    c.execute("SELECT monthly_rent, start_date FROM tenants WHERE id=?", (tenant_id,))
+    row = c.fetchone()
+    if not row:
+        return 0
+    rent, start_date = row
     c.execute("SELECT SUM(amount) FROM transactions WHERE tenant_id=?", (tenant_id,))
     paid = c.fetchone()[0] or 0
-    # Months since tenant added
-    c.execute("SELECT id FROM tenants WHERE id=?", (tenant_id,))
-    if not c.fetchone():
-        return 0
-    months = (datetime.date.today().year - 2020) * 12 + datetime.date.today().month  # simplification
+    # Months since the tenant's start date
+    start = datetime.date.fromisoformat(start_date or LEGACY_START_DATE)
+    today = datetime.date.today()
+    months = (today.year - start.year) * 12 + (today.month - start.month)
     expected = months * rent
-    conn.close()
     return paid - expected
 
+# One pass over tenants LEFT JOIN transactions: total paid and paid this month per tenant.
+# "This month" is the ISO range [first of month, first of next month) rather than
+# strftime('%Y-%m', date), so no per-row formatting and idx_tx_tenant_date stays usable.
+REPORT_SQL = """
+    SELECT t.id, t.name, t.monthly_rent, t.rental_address, t.original_address, t.start_date,
+           COALESCE(SUM(tx.amount), 0) AS paid,
+           COALESCE(SUM(CASE WHEN tx.date >= ? AND tx.date < ? THEN tx.amount END), 0) AS paid_this_month
+    FROM tenants t
+    LEFT JOIN transactions tx ON tx.tenant_id = t.id
+    GROUP BY t.id, t.name, t.monthly_rent, t.rental_address, t.original_address, t.start_date
+"""
+
+@st.cache_resource
+def get_duckdb():
+    """Read-only DuckDB view of rent.db for the Reports aggregate, or None when unavailable.
+
+    duckdb is optional: without it (or its sqlite extension) Reports reads through
+    sqlite3 as before. Writes always go through get_connection().
+    """
+    try:
+        import duckdb
+    except ImportError:
+        return None
+    try:
+        con = duckdb.connect()
+        con.execute("INSTALL sqlite; LOAD sqlite")
+        # ATTACH takes no bound parameters; quote the path as a SQL string literal
+        path = os.path.abspath(DB_FILE).replace("'", "''")
+        con.execute(f"ATTACH '{path}' AS r (TYPE SQLITE, READ_ONLY)")
+    except duckdb.Error:
+        return None
+    return con
+
 # -----------------------------
 # Pages
 # -----------------------------
 def page_login():
     st.title("🏠 Rent Collection System - Login")
 
-    username = st.text_input("Username")
-    password = st.text_input("Password", type="password")
+    username = st.text_input("Username", key="login_user")
+    password = st.text_input("Password", type="password", key="login_password")
 
     if st.button("Login"):
         user = login_user(username, password)
@@ -131,76 +264,85 @@ def page_tenant_management():
         rent = st.number_input("Monthly Rent", min_value=0.0, step=100.0)
         rental_address = st.text_area("Rental Property Address")
         original_address = st.text_area("Original Address")
+        start_date = st.date_input("Start Date", datetime.date.today())
         if st.button("Add Tenant"):
-            conn = get_connection()
-            c = conn.cursor()
-            c.execute("INSERT INTO tenants (name, monthly_rent, rental_address, original_address) VALUES (?, ?, ?, ?)",
-                      (name, rent, rental_address, original_address))
-            conn.commit()
-            conn.close()
+            with write_tx() as conn:
+                conn.execute("INSERT INTO tenants (name, monthly_rent, rental_address, original_address, start_date) VALUES (?, ?, ?, ?, ?)",
+                             (name, rent, rental_address, original_address, start_date.isoformat()))
+            _get_tenants.clear()
+            _get_tenant_options.clear()
+            _load_report.clear()
             st.success("Tenant added successfully!")
 
     with tab2:
         tenants = get_tenants()
         st.dataframe(tenants)
         if st.button("Download Tenant List (Excel)"):
-            towrite = BytesIO()
-            tenants.to_excel(towrite, index=False)
-            towrite.seek(0)
-            st.download_button("Download Tenant List", data=towrite, file_name="tenants.xlsx")
+            st.download_button("Download Tenant List", data=to_excel_bytes(tenants, "Tenants"),
+                               file_name="tenants.xlsx")
 
 def page_rent_collection():
     st.title("💰 Rent Collection")
 
-    tenants = get_tenants()
-    tenant_names = {row['name']: row['id'] for _, row in tenants.iterrows()}
+    tenants = get_tenant_options()
+    tenant_names = dict(zip(tenants['name'], tenants['id']))
 
     tenant_name = st.selectbox("Select Tenant", list(tenant_names.keys()))
     amount = st.number_input("Amount Paid", min_value=0.0, step=100.0)
 
     if st.button("Record Payment"):
-        conn = get_connection()
-        c = conn.cursor()
-        c.execute("INSERT INTO transactions (tenant_id, date, amount) VALUES (?, ?, ?)",
-                  (tenant_names[tenant_name], str(datetime.date.today()), amount))
-        conn.commit()
-        conn.close()
+        record_payments([(tenant_names[tenant_name], str(datetime.date.today()), amount)])
         st.success(f"Payment of {amount} recorded for {tenant_name}")
 
+# Short TTL as a safety net; Add Tenant and Record Payment clear it right away.
+@st.cache_data(ttl=30, show_spinner=False)
+def _load_report(first, next_first):
+    import pandas as pd
+    today = datetime.date.today()
+    params = (first.isoformat(), next_first.isoformat())
+    duck = get_duckdb()
+    if duck is not None:
+        # a cursor per call (DuckDB connections are not shared across threads);
+        # the default catalog is per cursor, so point each one at the attached DB
+        cur = duck.cursor()
+        cur.execute("USE r")
+        df = cur.execute(REPORT_SQL, params).df()
+    else:
+        df = pd.read_sql(REPORT_SQL, get_connection(), params=params)
+    # months since each tenant's start date, computed column-wise (same rule as calculate_balance)
+    start = pd.to_datetime(df["start_date"].fillna(LEGACY_START_DATE))
+    df["months"] = (today.year - start.dt.year) * 12 + (today.month - start.dt.month)
+    df["Balance"] = df["paid"] - df["months"] * df["monthly_rent"]
+    df["Status"] = ""
+    df.loc[(df["Balance"] == 0) & (df["paid_this_month"] < df["monthly_rent"]), "Status"] = "🟡"
+    df.loc[df["Balance"] < 0, "Status"] = "🔴"
+    df = df.rename(columns={
+        "name": "Tenant", "monthly_rent": "Monthly Rent",
+        "rental_address": "Rental Address", "original_address": "Original Address",
+    })
+    return df[["Tenant", "Monthly Rent", "Balance", "Status", "Rental Address", "Original Address"]]
+
+@st.fragment
+def _render_report_table():
+    first = datetime.date.today().replace(day=1)
+    next_first = (first + datetime.timedelta(days=32)).replace(day=1)
+    st.dataframe(_load_report(first, next_first))
+
 def page_reports():
     st.title("📊 Reports")
-
-    tenants = get_tenants()
-    rows = []
-    for _, t in tenants.iterrows():
-        bal = calculate_balance(t['id'])
-        color = ""
-        if bal < 0:
-            color = "🔴"
-        elif bal == 0:
-            # check if current month paid
-            conn = get_connection()
-            c = conn.cursor()
-            c.execute("SELECT SUM(amount) FROM transactions WHERE tenant_id=? AND strftime('%Y-%m', date)=?",
-                      (t['id'], datetime.date.today().strftime("%Y-%m")))
-            paid = c.fetchone()[0] or 0
-            if paid < t['monthly_rent']:
-                color = "🟡"
-            conn.close()
-        rows.append([t['name'], t['monthly_rent'], bal, color, t['rental_address'], t['original_address']])
-    df = pd.DataFrame(rows, columns=["Tenant", "Monthly Rent", "Balance", "Status", "Rental Address", "Original Address"])
-    st.dataframe(df)
+    _render_report_table()
 
 def page_ledger():
+    import pandas as pd
     st.title("📒 Tenant Ledger")
 
-    tenants = get_tenants()
-    tenant_names = {row['name']: row['id'] for _, row in tenants.iterrows()}
+    tenants = get_tenant_options()
+    tenant_names = dict(zip(tenants['name'], tenants['id']))
     tenant_name = st.selectbox("Select Tenant", list(tenant_names.keys()))
     tid = tenant_names[tenant_name]
 
-    transactions = get_transactions()
-    ledger = transactions[transactions['tenant_id'] == tid]
+    ledger = pd.read_sql("SELECT date, amount FROM transactions WHERE tenant_id=? ORDER BY date DESC",
+                         get_connection(), params=(tid,))
 
     st.write(f"### Ledger for {tenant_name}")
     st.dataframe(ledger)
@@ -216,14 +358,45 @@ def page_ledger():
 def page_backup_restore():
     st.title("💾 Backup & Restore")
 
-    with open(DB_FILE, "rb") as f:
-        st.download_button("Download Backup", f, file_name="rent_backup.db")
-
-    uploaded = st.file_uploader("Upload Backup (rent.db)", type=["db"])
+    # Consistent snapshot via SQLite's online backup API (includes WAL contents), copied
+    # to a temp file under the write lock so no other session's transaction is open on
+    # the shared connection meanwhile. Only taken on request, not on every rerun.
+    if st.button("Prepare Backup"):
+        with tempfile.NamedTemporaryFile(suffix=".db", delete=False) as tmp:
+            snapshot = tmp.name
+        dst = sqlite3.connect(snapshot)
+        with get_write_lock():
+            get_connection().backup(dst)
+        dst.close()
+        with open(snapshot, "rb") as f:
+            st.download_button("Download Backup", f, file_name="rent_backup.db")
+        os.remove(snapshot)
+
+    if st.session_state.pop("restored", False):
+        st.success("Database restored!")
+
+    # Restore copies the upload into the live connection with the backup API under the
+    # write lock: every session keeps its connection and sees the restored data. The
+    # uploader is keyed per restore so a later rerun does not apply the same file again.
+    n = st.session_state.get("restore_n", 0)
+    uploaded = st.file_uploader("Upload Backup (rent.db)", type=["db"], key=f"restore_upload_{n}")
     if uploaded:
-        with open(DB_FILE, "wb") as f:
-            f.write(uploaded.read())
-        st.success("Database restored! Please refresh the app.")
+        with tempfile.NamedTemporaryFile(suffix=".db", delete=False) as tmp:
+            tmp.write(uploaded.getbuffer())
+        src = sqlite3.connect(tmp.name)
+        try:
+            with get_write_lock():
+                src.backup(get_connection())
+        except sqlite3.DatabaseError as e:
+            st.error(f"Not a valid SQLite backup: {e}")
+            return
+        finally:
+            src.close()
+            os.remove(tmp.name)
+        st.cache_data.clear()
+        st.session_state["restore_n"] = n + 1
+        st.session_state["restored"] = True
+        st.rerun()
 
 # -----------------------------
 # Main App
@@ -249,10 +422,9 @@ def main():
         choice = st.sidebar.radio("Navigate", ["Rent Collection"])
 
     if st.sidebar.button("Logout"):
-        st.session_state.logged_in = False
-        st.session_state.username = None
-        st.session_state.role = None
-        st.experimental_rerun()
+        # drop everything this browser session holds (login, typed password, widget state)
+        st.session_state.clear()
+        st.rerun()
 
     if choice == "Tenant Management":
         page_tenant_management()
@@ -382,26 +382,20 @@ def page_reports():
     nets = []
     cm_delay = []
     ym = dt.date.today().strftime("%Y-%m")
-    for _, r in tenants.iterrows():
-        nb = tenant_net_balance(int(r["id"]))
+    for tid in tenants["id"].tolist():
+        nb = tenant_net_balance(tid)
         nets.append(nb)
-        cm_delay.append(month_has_delay(int(r["id"]), ym))
+        cm_delay.append(month_has_delay(tid, ym))
     tenants["Net Balance"] = nets
     tenants["This Month Delayed?"] = cm_delay
 
-    # style: red for negative net, yellow if delayed this month
-    def row_style(row):
-        styles = []
-        for col in tenants.columns:
-            style = ""
-            if col == "Net Balance" and row["Net Balance"] < 0:
-                style = "background-color: red; color: white;"
-            elif col == "This Month Delayed?" and row["This Month Delayed?"]:
-                style = "background-color: yellow; color: black;"
-            styles.append(style)
-        return styles
-
-    st.dataframe(tenants.style.apply(row_style, axis=1), use_container_width=True)
+    # style: red for negative net, yellow if delayed this month (per-cell, only on those two columns)
+    styled = (
+        tenants.style
+        .map(lambda v: "background-color: red; color: white;" if v < 0 else "", subset=["Net Balance"])
+        .map(lambda v: "background-color: yellow; color: black;" if v else "", subset=["This Month Delayed?"])
+    )
+    st.dataframe(styled, use_container_width=True)
 
     # quick filters / export
     st.subheader("Export")
@@ -1,244 +1,376 @@
-import streamlit as st import sqlite3 import hashlib import datetime import pandas as pd from io import BytesIO
-
-============================
-
-Database Setup
-
-============================
-
-def get_connection(): return sqlite3.connect("rent_collection.db", check_same_thread=False)
-
-def init_db(): conn = get_connection() c = conn.cursor()
-
-# Users table
-c.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT UNIQUE,
-        password TEXT,
-        role TEXT
-    )
-""")
-
-# Tenants table
-c.execute("""
-    CREATE TABLE IF NOT EXISTS tenants (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT,
-        phone TEXT,
-        rent INTEGER,
-        property_address TEXT,
-        original_address TEXT,
-        opening_balance INTEGER DEFAULT 0,
-        advance_amount INTEGER DEFAULT 0,
-        start_date TEXT,
-        vacated INTEGER DEFAULT 0
-    )
-""")
-
-# Transactions table
-c.execute("""
-    CREATE TABLE IF NOT EXISTS transactions (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        tenant_id INTEGER,
-        date TEXT,
-        amount INTEGER,
-        remarks TEXT,
-        FOREIGN KEY(tenant_id) REFERENCES tenants(id)
-    )
-""")
-
-conn.commit()
-conn.close()
-
-============================
-
-Utility Functions
-
-============================
-
-def hash_password(password): return hashlib.sha256(password.encode()).hexdigest()
-
-def verify_password(password, hashed): return hash_password(password) == hashed
-
-def add_user(username, password, role): conn = get_connection() c = conn.cursor() try: c.execute("INSERT INTO users (username, password, role) VALUES (?, ?, ?)", (username, hash_password(password), role)) conn.commit() except: pass conn.close()
-
-============================
-
-Login Page
-
-============================
-
-def login(): st.title("🔑 Login") username = st.text_input("Username") password = st.text_input("Password", type="password") if st.button("Login"): conn = get_connection() c = conn.cursor() c.execute("SELECT password, role FROM users WHERE username=?", (username,)) row = c.fetchone() conn.close() if row and verify_password(password, row[0]): st.session_state["logged_in"] = True st.session_state["username"] = username st.session_state["role"] = row[1] st.experimental_rerun() else: st.error("Invalid credentials")
-
-============================
-
-Tenant Management
-
-============================
-
-def tenant_management(): st.header("🏢 Tenant Management")
-
-with st.form("add_tenant_form"):
-    name = st.text_input("Tenant Name")
-    phone = st.text_input("Phone")
-    rent = st.number_input("Monthly Rent", step=100, value=0)
-    property_address = st.text_input("Rental Property Address")
-    original_address = st.text_input("Original Address")
-    opening_balance = st.number_input("Opening Balance", step=100, value=0)
-    advance_amount = st.number_input("Advance Amount (Security Deposit)", step=100, value=0)
-    start_date = st.date_input("Start Date", datetime.date.today())
-    submit = st.form_submit_button("Add Tenant")
-
-    if submit:
-        conn = get_connection()
-        c = conn.cursor()
-        c.execute("""
-            INSERT INTO tenants (name, phone, rent, property_address, original_address, opening_balance, advance_amount, start_date, vacated)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0)
-        """, (name, phone, rent, property_address, original_address,
-              opening_balance + advance_amount, advance_amount, start_date))
-        conn.commit()
-        conn.close()
-        st.success(f"Tenant {name} added successfully!")
-
-# Show tenants
-conn = get_connection()
-df = pd.read_sql("SELECT * FROM tenants WHERE vacated=0", conn)
-conn.close()
-st.subheader("Active Tenants")
-st.dataframe(df)
-
-============================
-
-Rent Collection
-
-============================
-
-def rent_collection(): st.header("💰 Rent Collection")
-
-conn = get_connection()
-tenants = pd.read_sql("SELECT id, name FROM tenants WHERE vacated=0", conn)
-
-tenant_id = st.selectbox("Select Tenant", tenants["id"], format_func=lambda x: tenants.loc[tenants["id"] == x, "name"].values[0])
-amount = st.number_input("Amount Received", step=100, value=0)
-remarks = st.text_area("Remarks")
-if st.button("Record Payment"):
-    c = conn.cursor()
-    c.execute("INSERT INTO transactions (tenant_id, date, amount, remarks) VALUES (?, ?, ?, ?)",
-              (tenant_id, str(datetime.date.today()), amount, remarks))
-    conn.commit()
-    st.success("Payment recorded!")
-
-conn.close()
-
-============================
-
-Ledger View
-
-============================
-
-def ledger_view(): st.header("📒 Tenant Ledger") conn = get_connection() tenants = pd.read_sql("SELECT id, name FROM tenants WHERE vacated=0", conn)
-
-tenant_id = st.selectbox("Select Tenant", tenants["id"], format_func=lambda x: tenants.loc[tenants["id"] == x, "name"].values[0])
-df = pd.read_sql("SELECT date, amount, remarks FROM transactions WHERE tenant_id=?", conn, params=(tenant_id,))
-st.subheader("Transaction History")
-st.dataframe(df)
-conn.close()
-
-============================
-
-Reports
-
-============================
-
-def reports(): st.header("📊 Reports") conn = get_connection()
-
-tenants = pd.read_sql("SELECT * FROM tenants WHERE vacated=0", conn)
-balances = []
-
-for _, tenant in tenants.iterrows():
+import streamlit as st
+import sqlite3
+import hashlib
+import hmac
+import bcrypt
+import os
+import tempfile
+import threading
+import datetime
+from contextlib import contextmanager
+
+# pandas and the Excel engines are imported inside the functions that use them,
+# so the login page renders without paying their import cost.
+
+DB_FILE = "rent_collection.db"
+BCRYPT_ROUNDS = 11
+BCRYPT_MAX_BYTES = 72  # bcrypt's input limit; bcrypt 5+ raises ValueError beyond it
+
+# ============================
+# Database Setup
+# ============================
+
+@st.cache_resource
+def get_connection():
+    # One long-lived connection per process, reused across reruns and sessions.
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-20000")
+    return conn
+
+@st.cache_resource
+def get_write_lock():
+    # One open transaction at a time on the shared connection. Cached, not a module
+    # global, because Streamlit re-executes this script on every rerun.
+    return threading.Lock()
+
+@contextmanager
+def write_tx():
+    """BEGIN ... COMMIT on the shared connection under the write lock (rolled back on error)."""
+    conn = get_connection()
+    with get_write_lock():
+        conn.execute("BEGIN")
+        with conn:
+            yield conn
+
+def init_db():
+    conn = get_connection()
     c = conn.cursor()
-    c.execute("SELECT SUM(amount) FROM transactions WHERE tenant_id=?", (tenant["id"],))
-    total_paid = c.fetchone()[0] or 0
-
-    start_date = datetime.datetime.strptime(tenant["start_date"], "%Y-%m-%d").date()
-    months_stayed = (datetime.date.today().year - start_date.year) * 12 + (datetime.date.today().month - start_date.month)
 
-    balance = (months_stayed * tenant["rent"]) - total_paid + tenant["opening_balance"]
-
-    balances.append([tenant["name"], tenant["phone"], tenant["rent"], balance])
-
-df = pd.DataFrame(balances, columns=["Name", "Phone", "Rent", "Balance"])
-
-def highlight(row):
-    if row["Balance"] < 0:
-        return ["background-color: red"] * len(row)
-    elif row["Balance"] > 0:
-        return ["background-color: yellow"] * len(row)
-    else:
-        return [""] * len(row)
-
-st.dataframe(df.style.apply(highlight, axis=1))
-
-# Download as Excel
-if st.button("📥 Download Report"):
+    with write_tx():
+        # Users table
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT UNIQUE,
+                password TEXT,
+                role TEXT
+            )
+        """)
+
+        # Tenants table
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS tenants (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT,
+                phone TEXT,
+                rent INTEGER,
+                property_address TEXT,
+                original_address TEXT,
+                opening_balance INTEGER DEFAULT 0,
+                advance_amount INTEGER DEFAULT 0,
+                start_date TEXT,
+                vacated INTEGER DEFAULT 0
+            )
+        """)
+
+        # Transactions table
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS transactions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                tenant_id INTEGER,
+                date TEXT,
+                amount INTEGER,
+                remarks TEXT,
+                FOREIGN KEY(tenant_id) REFERENCES tenants(id)
+            )
+        """)
+
+        # Ledger lookups and the report's per-tenant sums
+        c.execute("CREATE INDEX IF NOT EXISTS idx_tx_tenant_date ON transactions(tenant_id, date)")
+
+# ============================
+# Utility Functions
+# ============================
+
+def hash_password(password):
+    pw = password.encode()
+    if len(pw) > BCRYPT_MAX_BYTES:
+        raise ValueError(f"password cannot be longer than {BCRYPT_MAX_BYTES} bytes")
+    return bcrypt.hashpw(pw, bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode()
+
+def verify_password(password, hashed):
+    if hashed.startswith("$2"):
+        pw = password.encode()
+        # no stored bcrypt hash can come from a longer password
+        if len(pw) > BCRYPT_MAX_BYTES:
+            return False
+        return bcrypt.checkpw(pw, hashed.encode())
+    # legacy unsalted SHA-256 hash from before bcrypt
+    return hmac.compare_digest(hashed, hashlib.sha256(password.encode()).hexdigest())
+
+def add_user(username, password, role):
+    hashed = hash_password(password)
+    try:
+        with write_tx() as conn:
+            conn.execute("INSERT INTO users (username, password, role) VALUES (?, ?, ?)",
+                         (username, hashed, role))
+    except sqlite3.IntegrityError:
+        pass
+
+# Table reads are cached and keyed on a cheap (row count, max id) token, so an
+# unchanged table is served from memory; writers also clear the cache explicitly.
+def _table_version(table):
+    return get_connection().execute(f"SELECT COUNT(*), COALESCE(MAX(id), 0) FROM {table}").fetchone()
+
+@st.cache_data(show_spinner=False)
+def _get_tenant_options(version):
+    import pandas as pd
+    return pd.read_sql("SELECT id, name FROM tenants WHERE vacated=0", get_connection())
+
+def get_tenant_options():
+    """Active tenants' (id, name) for the selectboxes."""
+    return _get_tenant_options(_table_version("tenants"))
+
+def to_excel_bytes(df, sheet_name):
+    import pandas as pd
+    from io import BytesIO
+    # Optional: xlsxwriter is the faster writer; fall back to openpyxl when absent.
+    # (Not constant_memory mode: that drops cells written out of row order, and
+    # to_excel writes column by column.)
+    try:
+        import xlsxwriter  # noqa: F401
+        engine = "xlsxwriter"
+    except ImportError:
+        engine = "openpyxl"
     output = BytesIO()
-    with pd.ExcelWriter(output, engine="openpyxl") as writer:
-        df.to_excel(writer, index=False, sheet_name="Report")
-    st.download_button("Download Excel", data=output.getvalue(), file_name="report.xlsx")
-
-conn.close()
-
-============================
-
-Backup & Restore
-
-============================
-
-def backup_restore(): st.header("💾 Backup & Restore") conn = get_connection() conn.close()
-
-with open("rent_collection.db", "rb") as f:
-    st.download_button("Download Database", f, file_name="backup_rent_collection.db")
-
-uploaded = st.file_uploader("Upload Backup", type="db")
-if uploaded:
-    with open("rent_collection.db", "wb") as f:
-        f.write(uploaded.getbuffer())
-    st.success("Database restored successfully!")
-
-============================
-
-Main App
-
-============================
-
-def main(): init_db()
-
-if "logged_in" not in st.session_state:
-    st.session_state["logged_in"] = False
-
-if not st.session_state["logged_in"]:
-    login()
-else:
-    st.sidebar.title("Navigation")
-    role = st.session_state["role"]
-
-    if role == "admin":
-        page = st.sidebar.radio("Go to", ["Tenant Management", "Rent Collection", "Ledger", "Reports", "Backup & Restore"])
-    else:  # employee
-        page = st.sidebar.radio("Go to", ["Rent Collection", "Reports"])
-
-    if page == "Tenant Management":
-        tenant_management()
-    elif page == "Rent Collection":
-        rent_collection()
-    elif page == "Ledger":
-        ledger_view()
-    elif page == "Reports":
-        reports()
-    elif page == "Backup & Restore":
-        backup_restore()
-
-if name == "main": main()
-
+    with pd.ExcelWriter(output, engine=engine) as writer:
+        df.to_excel(writer, index=False, sheet_name=sheet_name)
+    return output.getvalue()
+
+# ============================
+# Login Page
+# ============================
+
+def login():
+    st.title("🔑 Login")
+    username = st.text_input("Username", key="login_user")
+    password = st.text_input("Password", type="password", key="login_password")
+    if st.button("Login"):
+        conn = get_connection()
+        row = conn.execute("SELECT password, role FROM users WHERE username=?", (username,)).fetchone()
+        try:
+            ok = bool(row) and verify_password(password, row[0])
+        except ValueError:  # malformed stored hash
+            ok = False
+        if ok:
+            if not row[0].startswith("$2") and len(password.encode()) <= BCRYPT_MAX_BYTES:
+                # upgrade a legacy hash to bcrypt on successful login (a password too
+                # long for bcrypt keeps its legacy hash)
+                new_hash = hash_password(password)  # outside the write lock; bcrypt is slow
+                with write_tx():
+                    conn.execute("UPDATE users SET password=? WHERE username=?", (new_hash, username))
+            st.session_state["logged_in"] = True
+            st.session_state["username"] = username
+            st.session_state["role"] = row[1]
+            st.rerun()
+        else:
+            st.error("Invalid credentials")
+
+# ============================
+# Tenant Management
+# ============================
+
+def tenant_management():
+    import pandas as pd
+    st.header("🏢 Tenant Management")
+    conn = get_connection()
+
+    with st.form("add_tenant_form"):
+        name = st.text_input("Tenant Name")
+        phone = st.text_input("Phone")
+        rent = st.number_input("Monthly Rent", step=100, value=0)
+        property_address = st.text_input("Rental Property Address")
+        original_address = st.text_input("Original Address")
+        opening_balance = st.number_input("Opening Balance", step=100, value=0)
+        advance_amount = st.number_input("Advance Amount (Security Deposit)", step=100, value=0)
+        start_date = st.date_input("Start Date", datetime.date.today())
+        submit = st.form_submit_button("Add Tenant")
+
+        if submit:
+            with write_tx():
+                conn.execute("""
+                    INSERT INTO tenants (name, phone, rent, property_address, original_address, opening_balance, advance_amount, start_date, vacated)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0)
+                """, (name, phone, rent, property_address, original_address,
+                      opening_balance + advance_amount, advance_amount, start_date.isoformat()))
+            _get_tenant_options.clear()
+            load_report.clear()
+            st.success(f"Tenant {name} added successfully!")
+
+    # Show tenants
+    df = pd.read_sql("SELECT * FROM tenants WHERE vacated=0", conn)
+    st.subheader("Active Tenants")
+    st.dataframe(df)
+
+# ============================
+# Rent Collection
+# ============================
+
+def rent_collection():
+    st.header("💰 Rent Collection")
+    conn = get_connection()
+
+    tenants = get_tenant_options()
+    id_to_name = dict(zip(tenants["id"].tolist(), tenants["name"].tolist()))
+
+    tenant_id = st.selectbox("Select Tenant", list(id_to_name), format_func=id_to_name.__getitem__)
+    amount = st.number_input("Amount Received", step=100, value=0)
+    remarks = st.text_area("Remarks")
+    if st.button("Record Payment"):
+        with write_tx():
+            conn.execute("INSERT INTO transactions (tenant_id, date, amount, remarks) VALUES (?, ?, ?, ?)",
+                         (tenant_id, str(datetime.date.today()), amount, remarks))
+        load_report.clear()
+        st.success("Payment recorded!")
+
+# ============================
+# Ledger View
+# ============================
+
+def ledger_view():
+    import pandas as pd
+    st.header("📒 Tenant Ledger")
+    conn = get_connection()
+
+    tenants = get_tenant_options()
+    id_to_name = dict(zip(tenants["id"].tolist(), tenants["name"].tolist()))
+
+    tenant_id = st.selectbox("Select Tenant", list(id_to_name), format_func=id_to_name.__getitem__)
+    df = pd.read_sql("SELECT date, amount, remarks FROM transactions WHERE tenant_id=?", conn, params=(tenant_id,))
+    st.subheader("Transaction History")
+    st.dataframe(df)
+
+# ============================
+# Reports
+# ============================
+
+# Each tenant's total paid in one pass over transactions
+REPORT_SQL = """
+    SELECT t.name, t.phone, t.rent, t.opening_balance, t.start_date,
+           COALESCE(p.paid, 0) AS paid
+    FROM tenants t
+    LEFT JOIN (SELECT tenant_id, SUM(amount) AS paid FROM transactions GROUP BY tenant_id) p
+           ON p.tenant_id = t.id
+    WHERE t.vacated = 0
+"""
+
+def color_bal(v):
+    return "background-color: red" if v < 0 else ("background-color: yellow" if v > 0 else "")
+
+# Short TTL as a safety net; Add Tenant and Record Payment clear it right away.
+@st.cache_data(ttl=30, show_spinner=False)
+def load_report(month):
+    import pandas as pd
+    today = datetime.date.today()
+    tenants = pd.read_sql(REPORT_SQL, get_connection())
+    start = pd.to_datetime(tenants["start_date"])
+    months_stayed = (today.year - start.dt.year) * 12 + (today.month - start.dt.month)
+    balance = months_stayed * tenants["rent"] - tenants["paid"] + tenants["opening_balance"]
+    return pd.DataFrame({"Name": tenants["name"], "Phone": tenants["phone"],
+                         "Rent": tenants["rent"], "Balance": balance})
+
+@st.fragment
+def report_table():
+    df = load_report(datetime.date.today().strftime("%Y-%m"))
+    st.dataframe(df.style.map(color_bal, subset=["Balance"]))
+
+    # Download as Excel
+    if st.button("📥 Download Report"):
+        st.download_button("Download Excel", data=to_excel_bytes(df, "Report"), file_name="report.xlsx")
+
+def reports():
+    st.header("📊 Reports")
+    report_table()
+
+# ============================
+# Backup & Restore
+# ============================
+
+def backup_restore():
+    st.header("💾 Backup & Restore")
+
+    # Consistent snapshot via SQLite's online backup API, served from a temp file;
+    # only taken on request, under the write lock so no transaction is open meanwhile
+    if st.button("Prepare Backup"):
+        with tempfile.NamedTemporaryFile(suffix=".db", delete=False) as tmp:
+            snapshot = tmp.name
+        dst = sqlite3.connect(snapshot)
+        with get_write_lock():
+            get_connection().backup(dst)
+        dst.close()
+        with open(snapshot, "rb") as f:
+            st.download_button("Download Database", f, file_name="backup_rent_collection.db")
+        os.remove(snapshot)
+
+    if st.session_state.pop("restored", False):
+        st.success("Database restored successfully!")
+
+    # Copy the upload into the live connection under the write lock, so every page
+    # keeps its connection; re-key the uploader so the file is applied only once
+    n = st.session_state.get("restore_n", 0)
+    uploaded = st.file_uploader("Upload Backup", type="db", key=f"restore_upload_{n}")
+    if uploaded:
+        with tempfile.NamedTemporaryFile(suffix=".db", delete=False) as tmp:
+            tmp.write(uploaded.getbuffer())
+        src = sqlite3.connect(tmp.name)
+        try:
+            with get_write_lock():
+                src.backup(get_connection())
+        except sqlite3.DatabaseError as e:
+            st.error(f"Not a valid SQLite backup: {e}")
+            return
+        finally:
+            src.close()
+            os.remove(tmp.name)
+        st.cache_data.clear()
+        st.session_state["restore_n"] = n + 1
+        st.session_state["restored"] = True
+        st.rerun()
+
+# ============================
+# Main App
+# ============================
+
+def main():
+    init_db()
+
+    if "logged_in" not in st.session_state:
+        st.session_state["logged_in"] = False
+
+    if not st.session_state["logged_in"]:
+        login()
+    else:
+        st.sidebar.title("Navigation")
+        role = st.session_state["role"]
+
+        if role == "admin":
+            page = st.sidebar.radio("Go to", ["Tenant Management", "Rent Collection", "Ledger", "Reports", "Backup & Restore"])
+        else:  # employee
+            page = st.sidebar.radio("Go to", ["Rent Collection", "Reports"])
+
+        if page == "Tenant Management":
+            tenant_management()
+        elif page == "Rent Collection":
+            rent_collection()
+        elif page == "Ledger":
+            ledger_view()
+        elif page == "Reports":
+            reports()
+        elif page == "Backup & Restore":
+            backup_restore()
+
+if __name__ == "__main__":
+    main()